@@ -1,26 +1,53 @@
 import json
 import os
-import boto3
-import uuid
-from botocore.exceptions import ClientError
+from secrets import token_hex
 from aws_lambda_powertools.utilities.typing import LambdaContext
 from common_utils import (
     logger, tracer, metrics, 
-    bedrock_agent_runtime,
-    DecimalEncoder,
+    get_bedrock_agent_runtime,
+    json_loads,
+    json_dumps,
     create_response, 
-    handle_client_error, 
-    handle_general_exception,
-    handle_options_request
+    create_serialized_response,
+    cors_preflight,
+    lambda_error_boundary
 )
 
 # Get environment variables
 AGENT_ID = os.environ.get('AGENT_ID')
 AGENT_ALIAS_ID = 'TSTALIASID'
+KNOWLEDGE_BASE_ID = os.environ.get('KNOWLEDGE_BASE_ID')
 
+# Validate the agent configuration once per container rather than per request
+AGENT_CONFIGURED = bool(AGENT_ID and AGENT_ALIAS_ID)
+
+# Knowledge base configuration with hybrid search, built once per container
+_KB_CONFIG = [{
+    'knowledgeBaseId': KNOWLEDGE_BASE_ID,
+    'retrievalConfiguration': {
+        'vectorSearchConfiguration': {
+            'numberOfResults': 5,  # Number of results to return
+            'overrideSearchType': 'HYBRID'  # Enable hybrid search (semantic & text)
+        }
+    }
+}] if KNOWLEDGE_BASE_ID else None
+
+# Constant error bodies, serialized once per container
+_ERR_MISSING_BODY = json_dumps({"error": "Missing request body"})
+_ERR_INVALID_JSON = json_dumps({"error": "Invalid JSON in request body"})
+_ERR_MISSING_QUERY = json_dumps({"error": "Missing 'query' parameter in request body"})
+_ERR_AGENT_NOT_CONFIGURED = json_dumps({"error": "Agent ID or Agent Alias ID not configured"})
+
+if not AGENT_CONFIGURED:
+    logger.error("Agent ID or Agent Alias ID not configured")
+if not KNOWLEDGE_BASE_ID:
+    logger.warning("No knowledge base ID found in environment variables")
+
+@cors_preflight
 @logger.inject_lambda_context
 @tracer.capture_lambda_handler
 @metrics.log_metrics
+@lambda_error_boundary(client_error_metric="BedrockAgentError", error_metric="InvokeAgentError")
 def handler(event, context: LambdaContext):
     """
     Lambda function handler to invoke a Bedrock Agent
@@ -32,286 +59,327 @@ def handler(event, context: LambdaContext):
     Returns:
         dict: API Gateway Lambda Proxy Output Format
     """
+    # Parse the request body
+    if 'body' not in event:
+        return create_serialized_response(event, 400, _ERR_MISSING_BODY)
+    
     try:
-        # Handle OPTIONS request for CORS
-        options_response = handle_options_request(event)
-        if options_response:
-            return options_response
-
-        # Parse the request body
-        if 'body' not in event:
-            return create_response(event, 400, {"error": "Missing request body"})
-        
-        try:
-            body = json.loads(event['body'])
-        except json.JSONDecodeError:
-            return create_response(event, 400, {"error": "Invalid JSON in request body"})
-        
-        # Extract query from request body
-        if 'query' not in body:
-            return create_response(event, 400, {"error": "Missing 'query' parameter in request body"})
-        
-        query = body['query']
-        
-        # Extract sessionId from request body (if provided)
-        session_id = body.get('sessionId')
+        body = json_loads(event['body'])
+    except json.JSONDecodeError:
+        return create_serialized_response(event, 400, _ERR_INVALID_JSON)
+    
+    # Extract query from request body
+    if 'query' not in body:
+        return create_serialized_response(event, 400, _ERR_MISSING_QUERY)
+    
+    query = body['query']
+    
+    # Extract sessionId from request body (if provided)
+    session_id = body.get('sessionId')
+    
+    # Traces are opt-in and citations opt-out, skipping them avoids extracting and returning them
+    want_traces = bool(body.get('returnTraces', False))
+    want_citations = bool(body.get('returnCitations', True))
 
-        # Check if Agent ID is configured
-        if not AGENT_ID or not AGENT_ALIAS_ID:
-            return create_response(event, 500, {"error": "Agent ID or Agent Alias ID not configured"})
-        
-        # Invoke the Bedrock Agent
-        response, used_session_id = invoke_agent(query, session_id)
-        
-        # Return the response with the session ID
-        return create_response(event, 200, {
-            "results": response,
-            "sessionId": used_session_id
-        })
+    # Check if Agent ID is configured
+    if not AGENT_CONFIGURED:
+        return create_serialized_response(event, 500, _ERR_AGENT_NOT_CONFIGURED)
+    
+    # Invoke the Bedrock Agent
+    response, used_session_id = invoke_agent(query, session_id, want_traces, want_citations)
     
-    except ClientError as e:
-        return handle_client_error(event, e, "BedrockAgentError")
-    except Exception as e:
-        return handle_general_exception(event, e, "InvokeAgentError")
+    # Return the response with the session ID
+    return create_response(event, 200, {
+        "results": response,
+        "sessionId": used_session_id
+    })
 
 @tracer.capture_method
-def invoke_agent(query, session_id=None):
+def invoke_agent(query, session_id=None, want_traces=False, want_citations=True):
     """
     Invoke the Bedrock Agent with the given query
     
     Args:
         query (str): The user's query to the agent
         session_id (str, optional): The session ID to maintain conversation context
+        want_traces (bool, optional): Whether to request and return the agent traces
+        want_citations (bool, optional): Whether to return the knowledge base citations
         
     Returns:
         tuple: (dict, str) - The agent's response and the session ID used
     """
-    try:
-        # Get knowledge base ID from environment variables
-        knowledge_base_id = os.environ.get('KNOWLEDGE_BASE_ID')
+    # Use provided session ID or generate a new one
+    if not session_id:
+        session_id = 'session-' + token_hex(16)
+        logger.info(f"Generated new session ID: {session_id}")
+    else:
+        logger.info(f"Using existing session ID: {session_id}")
+
+    #log agent id and agent alias id
+    logger.info(f"Agent ID: {AGENT_ID}")
+    logger.info(f"Agent Alias ID: {AGENT_ALIAS_ID}")
+
+    # Invoke the agent
+    invoke_params = {
+        'agentId': AGENT_ID,
+        'agentAliasId': AGENT_ALIAS_ID,
+        'sessionId': session_id,
+        'inputText': query,
+        'enableTrace': want_traces
+    }
+
+    # Add knowledge base configurations to sessionState if available
+    if _KB_CONFIG:
+        logger.info(f"Using knowledge base with hybrid search: {KNOWLEDGE_BASE_ID}")
+        invoke_params['sessionState'] = {
+            'knowledgeBaseConfigurations': _KB_CONFIG
+        }
+
+    # Invoke the agent and process the EventStream response
+    response = get_bedrock_agent_runtime().invoke_agent(**invoke_params)
+
+    # Process the EventStream response
+    processed_response = process_agent_response(response, want_traces, want_citations)
+
+    return processed_response, session_id
+
+def extract_reference(ref):
+    """
+    Extract the content, location and metadata from a retrieved reference
+    
+    Args:
+        ref (dict): A retrieved reference from a citation
         
-        # Configure knowledge base with hybrid search
-        knowledge_base_config = []
-        if knowledge_base_id:
-            knowledge_base_config = [{
-                'knowledgeBaseId': knowledge_base_id,
-                'retrievalConfiguration': {
-                    'vectorSearchConfiguration': {
-                        'numberOfResults': 5,  # Number of results to return
-                        'overrideSearchType': 'HYBRID'  # Enable hybrid search (semantic & text)
-                    }
-                }
-            }]
-            logger.info(f"Using knowledge base with hybrid search: {knowledge_base_id}")
-        else:
-            logger.warning("No knowledge base ID found in environment variables")
+    Returns:
+        dict: The extracted reference data, without the fields that are missing
+    """
+    content = ref.get('content')
+    if isinstance(content, dict):
+        content = content.get('text')
+    elif content is not None:
+        logger.warning(f"Reference content is not a dict: {type(content)}")
+        content = None
+    
+    return {
+        key: value
+        for key, value in (('content', content), ('location', ref.get('location')), ('metadata', ref.get('metadata')))
+        if value is not None
+    }
+
+def extract_citation(citation):
+    """
+    Extract the text span and retrieved references from a single citation
+    
+    Args:
+        citation (dict): A citation from the chunk attribution
         
-        # Use provided session ID or generate a new one
-        if not session_id:
-            session_id = f"session-{uuid.uuid4()}"
-            logger.info(f"Generated new session ID: {session_id}")
-        else:
-            logger.info(f"Using existing session ID: {session_id}")
+    Returns:
+        dict: The extracted citation data
+    """
+    # Extract text span information
+    text_part = citation.get('generatedResponsePart', {}).get('textResponsePart', {})
+    citation_data = {key: text_part[key] for key in ('text', 'span') if key in text_part}
+    
+    # Extract reference information
+    if 'retrievedReferences' in citation:
+        citation_data['references'] = [extract_reference(ref) for ref in citation['retrievedReferences']]
+    
+    return citation_data
+
+def iter_dict_chunk(chunk, want_citations=True):
+    """
+    Yield text and citations from a chunk delivered as a dictionary (the boto3 EventStream shape)
+    
+    Args:
+        chunk (dict): The chunk payload of a completion event
+        want_citations (bool, optional): Whether to extract the citations
         
-        #log agent id and agent alias id
-        logger.info(f"Agent ID: {AGENT_ID}")
-        logger.info(f"Agent Alias ID: {AGENT_ALIAS_ID}")
+    Yields:
+        tuple: ('text', str) or ('citation', dict) segments
+    """
+    chunk_bytes = chunk.get('bytes')
+    if isinstance(chunk_bytes, bytes):
+        yield 'text', chunk_bytes.decode('utf-8')
+    elif chunk_bytes is not None:
+        logger.warning(f"Chunk bytes is not bytes type: {type(chunk_bytes)}")
+    elif 'text' in chunk:
+        yield 'text', chunk['text']
+    
+    # Process citations if available
+    attribution = chunk.get('attribution') if want_citations else None
+    if attribution is not None:
+        if 'citations' in attribution:
+            for citation in attribution['citations']:
+                yield 'citation', extract_citation(citation)
+        else:
+            logger.warning("Attribution found but no citations key in it")
 
-        # Invoke the agent
-        invoke_params = {
-            'agentId': AGENT_ID,
-            'agentAliasId': AGENT_ALIAS_ID,
-            'sessionId': session_id,
-            'inputText': query
-        }
+def iter_object_chunk(chunk, want_citations=True):
+    """
+    Yield text and citations from a chunk exposing its payload as attributes
+    
+    Args:
+        chunk (object): The chunk payload of a completion event
+        want_citations (bool, optional): Whether to extract the citations
         
-        # Add knowledge base configurations to sessionState if available
-        if knowledge_base_config:
-            invoke_params['sessionState'] = {
-                'knowledgeBaseConfigurations': knowledge_base_config
-            }
-            
-        # Invoke the agent and process the EventStream response
-        response = bedrock_agent_runtime.invoke_agent(**invoke_params)
+    Yields:
+        tuple: ('text', str) or ('citation', dict) segments
+    """
+    chunk_bytes = getattr(chunk, 'bytes', None)
+    if chunk_bytes:
+        yield 'text', chunk_bytes.decode('utf-8')
+    else:
+        logger.warning(f"Chunk has no bytes attribute and is not a dict: {chunk}")
+    
+    if not want_citations:
+        return
+    
+    # Citations are only available as attributes for this chunk format
+    try:
+        citations = getattr(getattr(chunk, 'attribution', None), 'citations', None) or ()
+    except Exception as attr_err:
+        logger.error(f"Error accessing attribution attributes: {attr_err}")
+        citations = ()
+    for _ in citations:
+        yield 'citation', {'text': 'Citation from attribute access'}
+
+# Exception event types that can be delivered inside the agent EventStream
+_AGENT_ERROR_TYPES = frozenset({
+    'accessDeniedException', 'badGatewayException', 'conflictException',
+    'dependencyFailedException', 'internalServerException', 'modelNotReadyException',
+    'resourceNotFoundException', 'serviceQuotaExceededException',
+    'throttlingException', 'validationException'
+})
+
+# Chunk handlers indexed by the chunk type, anything else is read through attributes
+_CHUNK_HANDLERS = {
+    dict: iter_dict_chunk
+}
+
+# Fields picked from the trace event and its guardrail and orchestration subtrees
+_TRACE_KEYS = ('agentId', 'agentAliasId', 'agentVersion', 'sessionId')
+_GUARDRAIL_TRACE_KEYS = ('action', 'traceId')
+_GUARDRAIL_ASSESSMENT_KEYS = ('inputAssessments', 'outputAssessments')
+_ORCHESTRATION_TRACE_KEYS = ('modelInvocationInput', 'modelInvocationOutput')
+
+def extract_trace(trace):
+    """
+    Extract the agent, guardrail and orchestration details from a trace event
+    
+    Args:
+        trace (dict): The trace payload of a completion event
         
-        # Process the EventStream response
-        processed_response = process_agent_response(response)
+    Returns:
+        dict: The extracted trace data
+    """
+    # Extract basic trace information
+    trace_data = {key: trace[key] for key in _TRACE_KEYS if key in trace}
+    
+    # Extract detailed trace information if available
+    inner_trace = trace.get('trace')
+    if not inner_trace:
+        return trace_data
+    
+    # Extract guardrail trace information, including input/output assessments when present
+    guardrail_trace = inner_trace.get('guardrailTrace')
+    if guardrail_trace is not None:
+        guardrail_data = {key: guardrail_trace.get(key) for key in _GUARDRAIL_TRACE_KEYS}
+        guardrail_data.update((key, guardrail_trace[key]) for key in _GUARDRAIL_ASSESSMENT_KEYS if key in guardrail_trace)
+        trace_data['guardrail'] = guardrail_data
+    
+    # Extract orchestration trace information
+    orchestration_trace = inner_trace.get('orchestrationTrace')
+    if orchestration_trace is not None:
+        trace_data['orchestration'] = {key: orchestration_trace.get(key) for key in _ORCHESTRATION_TRACE_KEYS}
+    
+    return trace_data
+
+def iter_agent_events(response, want_traces=False, want_citations=True):
+    """
+    Consume the EventStream response from the Bedrock Agent as it arrives
+    
+    Args:
+        response (dict): The raw response from invoke_agent
+        want_traces (bool, optional): Whether to extract trace events
+        want_citations (bool, optional): Whether to extract citations
         
-        return processed_response, session_id
+    Yields:
+        tuple: ('text', str), ('citation', dict), ('trace', dict) or ('error', dict) segments
+    """
+    # The chunk handler is chosen once per stream from the type of the first chunk
+    chunk_handler = None
     
-    except ClientError as e:
-        logger.error(f"Error invoking Bedrock Agent: {e}")
-        raise e
-    except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        raise e
+    for event in response.get('completion', ()):
+        # Process text chunks and citations with the handler matching the chunk type
+        if 'chunk' in event:
+            chunk = event['chunk']
+            if chunk_handler is None:
+                chunk_handler = _CHUNK_HANDLERS.get(type(chunk), iter_object_chunk)
+            yield from chunk_handler(chunk, want_citations)
+        
+        # Process trace information
+        if want_traces and 'trace' in event:
+            yield 'trace', extract_trace(event['trace'])
+        
+        # Process any errors, the service sets at most one error per event
+        for error_type in _AGENT_ERROR_TYPES.intersection(event):
+            logger.error(f"Agent error: {error_type} - {event[error_type]}")
+            yield 'error', {
+                'type': error_type,
+                'message': event[error_type].get('message', 'Unknown error')
+            }
+            break
 
 @tracer.capture_method
-def process_agent_response(response):
+def process_agent_response(response, want_traces=False, want_citations=True):
     """
     Process the EventStream response from the Bedrock Agent
     
     Args:
         response (dict): The raw response from invoke_agent
+        want_traces (bool, optional): Whether to include the trace information
+        want_citations (bool, optional): Whether to include the citations
         
     Returns:
         dict: Processed response with text content, citations, and other relevant information
     """
-    try:
-        result = {
-            'text': '',
-            'citations': [],
-            'traces': []
-        }
+    result = {
+        'text': '',
+        'citations': [],
+        'traces': []
+    }
+
+    # Text fragments are joined once at the end instead of concatenated per chunk
+    text_parts: list[str] = []
 
-        # Process the EventStream completion
+    # Fold the streamed segments into the result, an error event terminates the stream
+    try:
+        for kind, value in iter_agent_events(response, want_traces, want_citations):
+            if kind == 'text':
+                text_parts.append(value)
+            elif kind == 'citation':
+                result['citations'].append(value)
+            elif kind == 'trace':
+                result['traces'].append(value)
+            elif kind == 'error':
+                result['error'] = value
+                break
+    finally:
+        # Release the HTTP connection back to the pool, even if the stream was not fully read
         if 'completion' in response:
-            # Iterate through events in completion
-            for i, event in enumerate(response['completion']):
+            response['completion'].close()
 
-                # Process text chunks
-                if 'chunk' in event:
-                    chunk = event['chunk']
+    result['text'] = ''.join(text_parts)
 
-                    # Handle bytes content
-                    if hasattr(chunk, 'bytes') and chunk.bytes:
-                        chunk_text = chunk.bytes.decode('utf-8')
-                        result['text'] += chunk_text
-                    elif isinstance(chunk, dict):
-                        # Try to extract text from dictionary structure
-                        if 'bytes' in chunk:
-                            if isinstance(chunk['bytes'], bytes):
-                                chunk_text = chunk['bytes'].decode('utf-8')
-                                result['text'] += chunk_text
-                            else:
-                                logger.warning(f"Chunk bytes is not bytes type: {type(chunk['bytes'])}")
-                        elif 'text' in chunk:
-                            result['text'] += chunk['text']
-                    else:
-                        logger.warning(f"Chunk has no bytes attribute and is not a dict: {chunk}")
-                    
-                    # Process citations if available
-                    if isinstance(chunk, dict) and 'attribution' in chunk:
-                        
-                        # Check if citations exist in the attribution
-                        if 'citations' in chunk['attribution']:
-                            for citation_idx, citation in enumerate(chunk['attribution']['citations']):
-                                citation_data = {}
-                                
-                                # Extract text span information
-                                if 'generatedResponsePart' in citation and 'textResponsePart' in citation['generatedResponsePart']:
-                                    text_part = citation['generatedResponsePart']['textResponsePart']
-                                    if 'text' in text_part:
-                                        citation_data['text'] = text_part['text']
-                                    if 'span' in text_part:
-                                        citation_data['span'] = text_part['span']
-                                
-                                # Extract reference information
-                                if 'retrievedReferences' in citation:
-                                    references = []
-                                    for ref_idx, ref in enumerate(citation['retrievedReferences']):
-                                        ref_data = {}
-                                        
-                                        # Extract content
-                                        if 'content' in ref:
-                                            if isinstance(ref['content'], dict):
-                                                if 'text' in ref['content']:
-                                                    ref_data['content'] = ref['content']['text']
-                                            else:
-                                                logger.warning(f"Reference content is not a dict: {type(ref['content'])}")
-                                        
-                                        # Extract location information
-                                        if 'location' in ref:
-                                            ref_data['location'] = ref['location']
-                                        
-                                        # Extract metadata
-                                        if 'metadata' in ref:
-                                            ref_data['metadata'] = ref['metadata']
-                                        
-                                        references.append(ref_data)
-                                    
-                                    citation_data['references'] = references
-                                
-                                result['citations'].append(citation_data)
-                        else:
-                            logger.warning("Attribution found but no citations key in it")
-                    
-                    # Check for alternative citation formats
-                    if hasattr(chunk, 'attribution'):
-                        try:
-                            # Try to access citations as an attribute
-                            if hasattr(chunk.attribution, 'citations'):
-                                for citation in chunk.attribution.citations:
-                                    citation_data = {'text': 'Citation from attribute access'}
-                                    result['citations'].append(citation_data)
-                        except Exception as attr_err:
-                            logger.error(f"Error accessing attribution attributes: {attr_err}")
-                
-                # Process trace information
-                if 'trace' in event:
-                    trace_data = {}
-                    
-                    # Extract basic trace information
-                    for key in ['agentId', 'agentAliasId', 'agentVersion', 'sessionId']:
-                        if key in event['trace']:
-                            trace_data[key] = event['trace'][key]
-                    
-                    # Extract detailed trace information if available
-                    if 'trace' in event['trace']:
-                        inner_trace = event['trace']['trace']
-                        
-                        # Extract guardrail trace information
-                        if 'guardrailTrace' in inner_trace:
-                            guardrail_trace = inner_trace['guardrailTrace']
-                            trace_data['guardrail'] = {
-                                'action': guardrail_trace.get('action'),
-                                'traceId': guardrail_trace.get('traceId')
-                            }
-                            
-                            # Extract input/output assessments
-                            if 'inputAssessments' in guardrail_trace:
-                                trace_data['guardrail']['inputAssessments'] = guardrail_trace['inputAssessments']
-                            if 'outputAssessments' in guardrail_trace:
-                                trace_data['guardrail']['outputAssessments'] = guardrail_trace['outputAssessments']
-                        
-                        # Extract orchestration trace information
-                        if 'orchestrationTrace' in inner_trace:
-                            trace_data['orchestration'] = {
-                                'modelInvocationInput': inner_trace['orchestrationTrace'].get('modelInvocationInput'),
-                                'modelInvocationOutput': inner_trace['orchestrationTrace'].get('modelInvocationOutput')
-                            }
-                    
-                    result['traces'].append(trace_data)
-                
-                # Process any errors
-                for error_type in ['accessDeniedException', 'badGatewayException', 'conflictException', 
-                                  'dependencyFailedException', 'internalServerException', 'modelNotReadyException',
-                                  'resourceNotFoundException', 'serviceQuotaExceededException', 
-                                  'throttlingException', 'validationException']:
-                    if error_type in event:
-                        result['error'] = {
-                            'type': error_type,
-                            'message': event[error_type].get('message', 'Unknown error')
-                        }
-                        logger.error(f"Agent error: {error_type} - {event[error_type]}")
-        
-        # Add content type and other metadata if available
-        if 'contentType' in response:
-            result['contentType'] = response['contentType']
-        if 'memoryId' in response:
-            result['memoryId'] = response['memoryId']
-        
-        # Log the final processed result
-        if not result['text']:
-            logger.warning("No text was extracted from the response")
-        if not result['citations']:
-            logger.warning("No citations were extracted from the response")
-        return result
-    
-    except Exception as e:
-        logger.error(f"Error processing agent response: {e}", exc_info=True)
-        # Return a simplified response in case of processing error
-        return {
-            'text': 'Error processing agent response',
-            'error': str(e)
-        }
\ No newline at end of file
+    # Add content type and other metadata if available
+    if 'contentType' in response:
+        result['contentType'] = response['contentType']
+    if 'memoryId' in response:
+        result['memoryId'] = response['memoryId']
+
+    # Log the final processed result
+    if not result['text']:
+        logger.warning("No text was extracted from the response")
+    if want_citations and not result['citations']:
+        logger.warning("No citations were extracted from the response")
+    return result
@@ -1,49 +1,113 @@
-import json
 import os
 import boto3
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from botocore.exceptions import ClientError
 from aws_lambda_powertools.utilities.typing import LambdaContext
 from common_utils import (
     logger, tracer, metrics, 
-    create_response, handle_options_request, 
-    handle_client_error, handle_general_exception
+    AWS_CLIENT_CONFIG,
+    create_response, cors_preflight, 
+    json_loads,
+    json_dumps,
+    create_serialized_response, UNSUPPORTED_OPERATION_BODY,
+    handle_client_error, lambda_error_boundary
 )
 
 # Initialize AWS clients
-bedrock = boto3.client('bedrock')
-bedrock_agent = boto3.client('bedrock-agent')
-bedrock_agent_runtime = boto3.client('bedrock-agent-runtime')
+bedrock = boto3.client('bedrock', config=AWS_CLIENT_CONFIG)
+bedrock_agent = boto3.client('bedrock-agent', config=AWS_CLIENT_CONFIG)
 
+# Thread pools for the I/O bound guardrail detail lookups, reused across warm invocations.
+# Versions get their own pool so guardrail tasks never wait on work queued behind them.
+_executor = ThreadPoolExecutor(max_workers=16)
+_version_executor = ThreadPoolExecutor(max_workers=16)
+
+# Constant error bodies, serialized once per container
+_ERR_AGENT_ID_REQUIRED = json_dumps({'error': 'agentId is required'})
+
+# Number of guardrails requested per list_guardrails page
+GUARDRAILS_PAGE_SIZE = 100
+
+@cors_preflight
 @logger.inject_lambda_context
 @tracer.capture_lambda_handler
 @metrics.log_metrics
+@lambda_error_boundary
 def handler(event, context: LambdaContext):
+    # Get the path and method to determine the operation
+    path = event.get('path', '')
+    http_method = event.get('httpMethod', '')
+    
+    if http_method == 'GET':
+        # Check if projectId is provided for single item retrieval
+        path_parameters = event.get('pathParameters', {})
+        if path_parameters and path_parameters.get('agentId'):
+            return get_agent_guardrail(event, event['pathParameters']['agentId'])
+        return list_guardrails(event)
+    elif path == '/guardrails' and http_method == 'PUT':
+        return update_agent_guardrail(event)
+    else:
+        logger.warning(f"Unsupported path or method: {path}, {http_method}")
+        return create_serialized_response(event, 400, UNSUPPORTED_OPERATION_BODY)
+
+def list_all_guardrails(**kwargs):
+    """
+    List guardrails across all result pages
+    """
+    paginator = bedrock.get_paginator('list_guardrails')
+    return [
+        guardrail
+        for page in paginator.paginate(PaginationConfig={'PageSize': GUARDRAILS_PAGE_SIZE}, **kwargs)
+        for guardrail in page.get('guardrails', [])
+    ]
+
+def get_guardrail_version(guardrail_id, version_info):
+    """
+    Get the details of a single published guardrail version
+    """
+    version = version_info.get('version')
     try:
-        # Check if this is a preflight OPTIONS request
-        options_response = handle_options_request(event)
-        if options_response:
-            return options_response
+        return bedrock.get_guardrail(
+            guardrailIdentifier=guardrail_id,
+            guardrailVersion=version
+        )
+    except ClientError as e:
+        logger.warning(f"Error getting details for guardrail {guardrail_id} version {version}: {str(e)}")
+        # Include basic version info without details
+        return version_info
+
+def get_guardrail_with_versions(guardrail):
+    """
+    Get the DRAFT details and all published versions of a guardrail
+    """
+    guardrail_id = guardrail.get('id')
+    
+    try:
+        # Get the DRAFT version details
+        draft_detail = bedrock.get_guardrail(
+            guardrailIdentifier=guardrail_id
+        )
         
-        # Get the path and method to determine the operation
-        path = event.get('path', '')
-        http_method = event.get('httpMethod', '')
+        # Now list all versions of this guardrail
+        all_versions = list_all_guardrails(guardrailIdentifier=guardrail_id)
         
-        if http_method == 'GET':
-            # Check if projectId is provided for single item retrieval
-            path_parameters = event.get('pathParameters', {})
-            if path_parameters and path_parameters.get('agentId'):
-                return get_agent_guardrail(event, event['pathParameters']['agentId'])
-            return list_guardrails(event)
-        elif path == '/guardrails' and http_method == 'PUT':
-            return update_agent_guardrail(event)
-        else:
-            logger.warning(f"Unsupported path or method: {path}, {http_method}")
-            return create_response(event, 400, {'error': 'Unsupported operation'})
-            
-    except boto3.exceptions.botocore.exceptions.ClientError as e:
-        return handle_client_error(event, e)
-    except Exception as e:
-        return handle_general_exception(event, e)
+        # Get detailed information for each version, we already have the DRAFT version
+        version_details = list(_version_executor.map(
+            lambda version_info: get_guardrail_version(guardrail_id, version_info),
+            [v for v in all_versions if v.get('version') != 'DRAFT']
+        ))
+        
+        # Combine DRAFT with other versions
+        return {
+            'guardrailId': guardrail_id,
+            'name': guardrail.get('name'),
+            'versions': [draft_detail] + version_details
+        }
+        
+    except ClientError as e:
+        logger.warning(f"Error getting details for guardrail {guardrail_id}: {str(e)}")
+        # Include basic info without details
+        return guardrail
 
 @tracer.capture_method
 def list_guardrails(event):
@@ -54,56 +118,16 @@ def list_guardrails(event):
     
     try:
         # First, list all guardrails (without guardrailIdentifier to get the DRAFT versions)
-        response = bedrock.list_guardrails()
-        guardrails = response.get('guardrails', [])
+        guardrails = list_all_guardrails()
         
-        # Get detailed information for each guardrail including all versions
-        detailed_guardrails = []
-        for guardrail in guardrails:
-            guardrail_id = guardrail.get('id')
-            
-            # Get the DRAFT version details
-            try:
-                draft_detail = bedrock.get_guardrail(
-                    guardrailIdentifier=guardrail_id
-                )
-                
-                # Now list all versions of this guardrail
-                all_versions_response = bedrock.list_guardrails(
-                    guardrailIdentifier=guardrail_id
-                )
-                all_versions = all_versions_response.get('guardrails', [])
-                
-                # Get detailed information for each version
-                version_details = []
-                for version_info in all_versions:
-                    version = version_info.get('version')
-                    if version != 'DRAFT':  # We already have the DRAFT version
-                        try:
-                            version_detail = bedrock.get_guardrail(
-                                guardrailIdentifier=guardrail_id,
-                                guardrailVersion=version
-                            )
-                            version_details.append(version_detail)
-                        except ClientError as e:
-                            logger.warning(f"Error getting details for guardrail {guardrail_id} version {version}: {str(e)}")
-                            # Include basic version info without details
-                            version_details.append(version_info)
-                
-                # Combine DRAFT with other versions
-                all_versions_details = [draft_detail] + version_details
-                
-                # Add the guardrail with all its versions
-                detailed_guardrails.append({
-                    'guardrailId': guardrail_id,
-                    'name': guardrail.get('name'),
-                    'versions': all_versions_details
-                })
-                
-            except ClientError as e:
-                logger.warning(f"Error getting details for guardrail {guardrail_id}: {str(e)}")
-                # Include basic info without details
-                detailed_guardrails.append(guardrail)
+        # Get detailed information for each guardrail in parallel, preserving the listing order
+        futures = {
+            _executor.submit(get_guardrail_with_versions, guardrail): index
+            for index, guardrail in enumerate(guardrails)
+        }
+        detailed_guardrails = [None] * len(guardrails)
+        for future in as_completed(futures):
+            detailed_guardrails[futures[future]] = future.result()
         
         logger.info(f"Successfully retrieved {len(detailed_guardrails)} guardrails with all versions")
         metrics.add_metric(name="SuccessfulGuardrailsList", unit="Count", value=1)
@@ -124,9 +148,7 @@ def get_agent_guardrail(event, agent_id):
     """
     try:
         # Get the agent details
-        agent_response = bedrock_agent.get_agent(
-            agentId=agent_id
-        )
+        agent_response = bedrock_agent.get_agent(agentId=agent_id)
         
         # Check if the agent has a guardrail configuration
         guardrail_config = agent_response.get('agent').get('guardrailConfiguration', {})
@@ -183,6 +205,7 @@ def get_agent_guardrail(event, agent_id):
 def prepare_updated_agent(agent_id):
     """
     Prepare the agent once its configuration has been updated.
+    prepare_agent only starts the preparation, so errors are logged rather than failing the update.
     """
 
     try:
@@ -191,7 +214,9 @@ def prepare_updated_agent(agent_id):
     except ClientError as e:
         logger.error(f"Error preparing agent: {str(e)}")
         metrics.add_metric(name="PrepareAgentError", unit="Count", value=1)
-        return handle_client_error(event, e, "PrepareAgentError")
+    except Exception as e:
+        logger.exception(f"Unexpected error preparing agent: {str(e)}")
+        metrics.add_metric(name="PrepareAgentError", unit="Count", value=1)
     
 @tracer.capture_method
 def update_agent_guardrail(event):
@@ -199,21 +224,19 @@ def update_agent_guardrail(event):
     Handle PUT /guardrails endpoint to update the agent's guardrail
     """
     # Parse the request body
-    body = json.loads(event.get('body', '{}'))
+    body = json_loads(event.get('body', '{}'))
     
     # Get the guardrail ID and version from the request
     guardrail_id = body.get('guardrailId')
     guardrail_version = body.get('guardrailVersion', 'DRAFT')
     agent_id = body.get('agentId')
     if agent_id is None:
-        return create_response(event, 400, {'error': 'agentId is required'})
+        return create_serialized_response(event, 400, _ERR_AGENT_ID_REQUIRED)
     
     try:
         # First, get the current agent configuration to ensure it exists and get required fields
         try:
-            agent_response = bedrock_agent.get_agent(
-                agentId=agent_id
-            )
+            agent_response = bedrock_agent.get_agent(agentId=agent_id)
             agent_details = agent_response.get('agent', {})
             logger.info(f"Found agent {agent_id}")
         except ClientError as e:
@@ -250,30 +273,25 @@ def update_agent_guardrail(event):
                 logger.info(f"Agent {agent_id} has an existing guardrail that will be removed")
             
         else:
-            # If we're adding/updating a guardrail, verify it exists first
-            try:
-                guardrail_response = bedrock.get_guardrail(
-                    guardrailIdentifier=guardrail_id,
-                    guardrailVersion=guardrail_version
-                )
-                logger.info(f"Found guardrail {guardrail_id} with version {guardrail_version}")
-                
-                # Add guardrail configuration to the update parameters
-                update_params['guardrailConfiguration'] = {
-                    'guardrailIdentifier': guardrail_id,
-                    'guardrailVersion': guardrail_version
-                }
-                
-                logger.info(f"Setting guardrail {guardrail_id} with version {guardrail_version} for agent {agent_id}")
-                
-            except ClientError as e:
-                if e.response['Error']['Code'] == 'ResourceNotFoundException':
-                    logger.warning(f"Guardrail {guardrail_id} not found")
-                    return create_response(event, 404, {'error': f"Guardrail {guardrail_id} not found"})
-                raise
+            # Add guardrail configuration to the update parameters, update_agent rejects unknown guardrails
+            update_params['guardrailConfiguration'] = {
+                'guardrailIdentifier': guardrail_id,
+                'guardrailVersion': guardrail_version
+            }
+            
+            logger.info(f"Setting guardrail {guardrail_id} with version {guardrail_version} for agent {agent_id}")
         
         # Update the agent with a single call, either with or without guardrailConfiguration
-        update_response = bedrock_agent.update_agent(**update_params)
+        try:
+            update_response = bedrock_agent.update_agent(**update_params)
+        except ClientError as e:
+            # update_agent raises these for other invalid fields too, so only map errors about the guardrail
+            error = e.response['Error']
+            if (guardrail_id and error['Code'] in ('ValidationException', 'ResourceNotFoundException')
+                    and 'guardrail' in error.get('Message', '').lower()):
+                logger.warning(f"Guardrail {guardrail_id} not found: {str(e)}")
+                return create_response(event, 404, {'error': f"Guardrail {guardrail_id} not found"})
+            raise
         
         if not guardrail_id:
             logger.info(f"Successfully removed guardrail from agent {agent_id}")
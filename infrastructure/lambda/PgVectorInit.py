@@ -3,12 +3,193 @@ import boto3
 import os
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from common_utils import (
-    logger, tracer, metrics
+    logger, metrics
 )
 
+# Initialize RDS Data API client and Secrets Manager client
+rds_client = boto3.client('rds-data')
+secrets_client = boto3.client('secretsmanager')
+
+# Expected number of vectors in the knowledge base, used to size the HNSW index
+EXPECTED_VECTOR_COUNT = int(os.environ.get('EXPECTED_VECTOR_COUNT', '100000'))
+
+# Query time candidate list size for the bedrock_user sessions
+HNSW_EF_SEARCH = int(os.environ.get('HNSW_EF_SEARCH', '100'))
+
+# Memory and parallel workers available to the index builds, sized for the Aurora capacity
+MAINTENANCE_WORK_MEM = os.environ.get('MAINTENANCE_WORK_MEM', '1GB')
+MAX_PARALLEL_MAINTENANCE_WORKERS = int(os.environ.get('MAX_PARALLEL_MAINTENANCE_WORKERS', '2'))
+
+def hnsw_parameters(expected_vectors):
+    """
+    Pick the HNSW graph degree (m) and build candidate list size (ef_construction)
+    for the expected number of vectors, unless overridden by HNSW_M / HNSW_EF_CONSTRUCTION.
+    
+    Args:
+        expected_vectors (int): Expected number of vectors in the index
+        
+    Returns:
+        tuple: (m, ef_construction)
+    """
+    if expected_vectors < 100000:
+        m, ef_construction = 16, 64
+    elif expected_vectors < 1000000:
+        m, ef_construction = 24, 128
+    else:
+        m, ef_construction = 32, 200
+    return (
+        int(os.environ.get('HNSW_M', m)),
+        int(os.environ.get('HNSW_EF_CONSTRUCTION', ef_construction))
+    )
+
+HNSW_M, HNSW_EF_CONSTRUCTION = hnsw_parameters(EXPECTED_VECTOR_COUNT)
+
+# SQL statements, built once per container
+_SQL_SELECT_1 = 'SELECT 1;'
+_SQL_CREATE_EXTENSION = 'CREATE EXTENSION IF NOT EXISTS vector;'
+_SQL_PGVECTOR_VERSION = "SELECT extversion FROM pg_extension WHERE extname='vector';"
+_SQL_CREATE_SCHEMA = 'CREATE SCHEMA IF NOT EXISTS bedrock_integration;'
+
+# Names of the objects that already exist, so that Update events skip DDL with nothing to do
+_SQL_EXISTING_OBJECTS = """
+SELECT extname FROM pg_extension WHERE extname = 'vector'
+UNION ALL
+SELECT nspname FROM pg_namespace WHERE nspname = 'bedrock_integration'
+UNION ALL
+SELECT tablename FROM pg_tables WHERE schemaname = 'bedrock_integration' AND tablename = 'bedrock_kb'
+UNION ALL
+SELECT indexname FROM pg_indexes WHERE schemaname = 'bedrock_integration' AND tablename = 'bedrock_kb';
+"""
+
+# CREATE ROLE does not accept bind parameters, so the password is bound into a transaction
+# scoped setting and quoted as a literal by format() inside the DO block
+_SQL_BIND_PASSWORD = "SELECT set_config('bedrock_init.password', :password, true);"
+_SQL_UPSERT_ROLE = """
+DO $$
+BEGIN
+    IF EXISTS (SELECT FROM pg_roles WHERE rolname = 'bedrock_user') THEN
+        EXECUTE format('ALTER ROLE bedrock_user WITH PASSWORD %L', current_setting('bedrock_init.password'));
+    ELSE
+        EXECUTE format('CREATE ROLE bedrock_user WITH PASSWORD %L LOGIN', current_setting('bedrock_init.password'));
+    END IF;
+END
+$$;
+"""
+
+# bedrock_user only reads and writes the knowledge base rows, so grant just that
+_SQL_GRANT_SCHEMA = 'GRANT USAGE, CREATE ON SCHEMA bedrock_integration TO bedrock_user;'
+_SQL_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS bedrock_integration.bedrock_kb (
+    id UUID PRIMARY KEY,
+    embedding halfvec(1024),
+    chunks TEXT,
+    metadata JSON,
+    custom_metadata JSONB
+);
+"""
+_SQL_GRANT_TABLE = 'GRANT SELECT, INSERT, UPDATE, DELETE ON TABLE bedrock_integration.bedrock_kb TO bedrock_user;'
+
+# Transaction scoped settings that keep the HNSW graph in memory and parallelize the builds
+_SQL_INDEX_BUILD_SETTINGS = (
+    f"SET LOCAL maintenance_work_mem = '{MAINTENANCE_WORK_MEM}';",
+    f"SET LOCAL max_parallel_maintenance_workers = {MAX_PARALLEL_MAINTENANCE_WORKERS};",
+    f"SET LOCAL max_parallel_workers = {MAX_PARALLEL_MAINTENANCE_WORKERS + 1};"
+)
+
+# Index name to CREATE INDEX statement
+_SQL_CREATE_INDEXES = {
+    # HNSW index on the half precision vector column for similarity search, sized for the expected vector count
+    'vector_cosine_idx': f'CREATE INDEX IF NOT EXISTS vector_cosine_idx ON bedrock_integration.bedrock_kb USING hnsw (embedding halfvec_cosine_ops) WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION});',
+    # Text search index
+    'chunks_idx': "CREATE INDEX IF NOT EXISTS chunks_idx ON bedrock_integration.bedrock_kb USING gin (to_tsvector('simple', chunks));",
+    # Metadata index
+    'metadata_idx': 'CREATE INDEX IF NOT EXISTS metadata_idx ON bedrock_integration.bedrock_kb USING gin (custom_metadata);'
+}
+
+_SQL_SET_EF_SEARCH = f'ALTER ROLE bedrock_user SET hnsw.ef_search = {HNSW_EF_SEARCH};'
+
+def get_secret_password(secret_arn):
+    """
+    Fetch the password from a Secrets Manager secret. It is not cached, so an update after
+    the secret is rotated always applies the current password.
+    
+    Args:
+        secret_arn (str): ARN of the secret
+        
+    Returns:
+        str: The password field of the secret
+    """
+    secret = secrets_client.get_secret_value(SecretId=secret_arn)
+    return json.loads(secret['SecretString'])['password']
+
+def get_existing_objects(db_params):
+    """
+    Look up which of the extension, schema, table and indexes already exist in one query.
+    
+    Args:
+        db_params (dict): resourceArn, secretArn and database for the cluster
+        
+    Returns:
+        set: Names of the existing objects
+    """
+    response = rds_client.execute_statement(**db_params, sql=_SQL_EXISTING_OBJECTS)
+    return {record[0]['stringValue'] for record in response.get('records', [])}
+
+# Backoff between readiness checks while Aurora Serverless resumes, in seconds
+CLUSTER_READY_DELAYS = (0.5, 1, 2, 4, 8)
+
+def wait_for_cluster(db_params):
+    """
+    Poll the cluster with SELECT 1 until it accepts statements.
+    
+    Args:
+        db_params (dict): resourceArn, secretArn and database for the cluster
+    """
+    retryable = (
+        rds_client.exceptions.DatabaseResumingException,
+        rds_client.exceptions.BadRequestException
+    )
+    for delay in CLUSTER_READY_DELAYS:
+        try:
+            rds_client.execute_statement(**db_params, sql=_SQL_SELECT_1)
+            return
+        except retryable as e:
+            logger.info(f"Cluster not ready, retrying in {delay}s: {str(e)}")
+            # nosemgrep: arbitrary-sleep
+            time.sleep(delay)
+    
+    # Last attempt, let the error propagate if the cluster is still not ready
+    rds_client.execute_statement(**db_params, sql=_SQL_SELECT_1)
+
+def create_index(db_params, sql):
+    """
+    Build one index in its own transaction, with the index build settings applied.
+    
+    Args:
+        db_params (dict): resourceArn, secretArn and database for the cluster
+        sql (str): CREATE INDEX statement
+    """
+    transaction_id = rds_client.begin_transaction(**db_params)['transactionId']
+    try:
+        for setting_sql in _SQL_INDEX_BUILD_SETTINGS:
+            rds_client.execute_statement(**db_params, transactionId=transaction_id, sql=setting_sql)
+        rds_client.execute_statement(**db_params, transactionId=transaction_id, sql=sql)
+        rds_client.commit_transaction(
+            resourceArn=db_params['resourceArn'],
+            secretArn=db_params['secretArn'],
+            transactionId=transaction_id
+        )
+    except Exception:
+        rds_client.rollback_transaction(
+            resourceArn=db_params['resourceArn'],
+            secretArn=db_params['secretArn'],
+            transactionId=transaction_id
+        )
+        raise
+
 @logger.inject_lambda_context
-@tracer.capture_lambda_handler
 @metrics.log_metrics
 def handler(event, context):
     # Extract properties from the event
@@ -30,136 +211,133 @@ def handler(event, context):
             logger.info(f"Initializing vector for database {database_name}")
             metrics.add_metric(name="VectorInitAttempt", unit="Count", value=1)
             
-            # Initialize RDS Data API client and Secrets Manager client
-            rds_client = boto3.client('rds-data')
-            secrets_client = boto3.client('secretsmanager')
-            
             # Get the bedrock user password from Secrets Manager
-            bedrock_user_secret = secrets_client.get_secret_value(SecretId=bedrock_user_secret_arn)
-            bedrock_user_secret_json = json.loads(bedrock_user_secret['SecretString'])
-            bedrock_user_password = bedrock_user_secret_json['password']
+            bedrock_user_password = get_secret_password(bedrock_user_secret_arn)
             
-            # Wait for the cluster to be available
-
-            # nosemgrep: arbitrary-sleep
-            time.sleep(10)
-            
-            # Create pgvector extension
-            logger.info("Creating vector extension")
-            rds_client.execute_statement(
-                resourceArn=cluster_arn,
-                secretArn=secret_arn,
-                database=database_name,
-                sql='CREATE EXTENSION IF NOT EXISTS vector;'
-            )
-            
-            # Check pgvector version (must be 0.5.0 or higher)
-            logger.info("Checking pgvector version")
-            version_response = rds_client.execute_statement(
-                resourceArn=cluster_arn,
-                secretArn=secret_arn,
-                database=database_name,
-                sql="SELECT extversion FROM pg_extension WHERE extname='vector';"
-            )
+            db_params = {
+                'resourceArn': cluster_arn,
+                'secretArn': secret_arn,
+                'database': database_name
+            }
             
-            pgvector_version = version_response['records'][0][0]['stringValue']
-            logger.info(f"pgvector version: {pgvector_version}")
+            # Wait for the cluster to be available
+            wait_for_cluster(db_params)
             
-            # Create bedrock_integration schema
-            logger.info("Creating bedrock_integration schema")
-            rds_client.execute_statement(
-                resourceArn=cluster_arn,
-                secretArn=secret_arn,
-                database=database_name,
-                sql='CREATE SCHEMA IF NOT EXISTS bedrock_integration;'
-            )
+            existing_objects = get_existing_objects(db_params)
+            if existing_objects:
+                logger.info(f"Existing objects: {', '.join(sorted(existing_objects))}")
             
-            # Create bedrock_user role with appropriate permissions
-            logger.info("Creating bedrock_user role")
+            # Run the whole setup in a single transaction to avoid paying the connection
+            # and authentication overhead of the Data API on every statement
+            transaction_id = rds_client.begin_transaction(**db_params)['transactionId']
             try:
+                # Create pgvector extension
+                if 'vector' not in existing_objects:
+                    logger.info("Creating vector extension")
+                    rds_client.execute_statement(
+                        **db_params,
+                        transactionId=transaction_id,
+                        sql=_SQL_CREATE_EXTENSION
+                    )
+                
+                # Check pgvector version (must be 0.7.0 or higher for halfvec)
+                logger.info("Checking pgvector version")
+                version_response = rds_client.execute_statement(
+                    **db_params,
+                    transactionId=transaction_id,
+                    sql=_SQL_PGVECTOR_VERSION
+                )
+                
+                pgvector_version = version_response['records'][0][0]['stringValue']
+                logger.info(f"pgvector version: {pgvector_version}")
+                if tuple(int(part) for part in pgvector_version.split('.')[:2]) < (0, 7):
+                    raise ValueError(f"pgvector {pgvector_version} does not support halfvec, 0.7.0 or higher is required")
+                
+                # Create bedrock_integration schema
+                if 'bedrock_integration' not in existing_objects:
+                    logger.info("Creating bedrock_integration schema")
+                    rds_client.execute_statement(
+                        **db_params,
+                        transactionId=transaction_id,
+                        sql=_SQL_CREATE_SCHEMA
+                    )
+                
+                # Create bedrock_user role, or update its password if it already exists, so that
+                # a rotated secret is always applied.
+                # A failed CREATE ROLE would abort the transaction, so check the catalog instead.
+                logger.info("Creating bedrock_user role")
                 rds_client.execute_statement(
-                    resourceArn=cluster_arn,
-                    secretArn=secret_arn,
-                    database=database_name,
-                    sql=f"CREATE ROLE bedrock_user WITH PASSWORD '{bedrock_user_password}' LOGIN;"
+                    **db_params,
+                    transactionId=transaction_id,
+                    sql=_SQL_BIND_PASSWORD,
+                    parameters=[{'name': 'password', 'value': {'stringValue': bedrock_user_password}}]
+                )
+                rds_client.execute_statement(
+                    **db_params,
+                    transactionId=transaction_id,
+                    sql=_SQL_UPSERT_ROLE
+                )
+                
+                # Grant permissions to bedrock_user
+                logger.info("Granting permissions to bedrock_user")
+                rds_client.execute_statement(
+                    **db_params,
+                    transactionId=transaction_id,
+                    sql=_SQL_GRANT_SCHEMA
                 )
-            except Exception as e:
-                # Role might already exist, which is fine
-                logger.info(f"Note: {str(e)}")
                 
-                # Update the password for the existing role
-                try:
+                # Create vector table for Bedrock Knowledge Base
+                if 'bedrock_kb' not in existing_objects:
+                    logger.info("Creating bedrock_kb table in bedrock_integration schema")
                     rds_client.execute_statement(
-                        resourceArn=cluster_arn,
-                        secretArn=secret_arn,
-                        database=database_name,
-                        sql=f"ALTER ROLE bedrock_user WITH PASSWORD '{bedrock_user_password}';"
+                        **db_params,
+                        transactionId=transaction_id,
+                        sql=_SQL_CREATE_TABLE
                     )
-                    logger.info("Updated password for existing bedrock_user role")
-                except Exception as e2:
-                    logger.error(f"Error updating password: {str(e2)}")
-            
-            # Grant permissions to bedrock_user
-            logger.info("Granting permissions to bedrock_user")
-            rds_client.execute_statement(
-                resourceArn=cluster_arn,
-                secretArn=secret_arn,
-                database=database_name,
-                sql='GRANT ALL ON SCHEMA bedrock_integration TO bedrock_user;'
-            )
-            
-            # Create vector table for Bedrock Knowledge Base
-            logger.info("Creating bedrock_kb table in bedrock_integration schema")
-            rds_client.execute_statement(
-                resourceArn=cluster_arn,
-                secretArn=secret_arn,
-                database=database_name,
-                sql='''
-                CREATE TABLE IF NOT EXISTS bedrock_integration.bedrock_kb (
-                    id UUID PRIMARY KEY,
-                    embedding vector(1024),
-                    chunks TEXT,
-                    metadata JSON,
-                    custom_metadata JSONB
-                );
-                '''
-            )
-            
-            # Grant permissions on the table to bedrock_user
-            logger.info("Granting permissions on bedrock_kb table to bedrock_user")
-            rds_client.execute_statement(
-                resourceArn=cluster_arn,
-                secretArn=secret_arn,
-                database=database_name,
-                sql='GRANT ALL ON TABLE bedrock_integration.bedrock_kb TO bedrock_user;'
-            )
-            
-            # Create HNSW index on the vector column for similarity search with recommended settings
-            logger.info("Creating vector index with HNSW")
-            rds_client.execute_statement(
-                resourceArn=cluster_arn,
-                secretArn=secret_arn,
-                database=database_name,
-                sql='CREATE INDEX IF NOT EXISTS vector_cosine_idx ON bedrock_integration.bedrock_kb USING hnsw (embedding vector_cosine_ops) WITH (ef_construction=256);'
-            )
+                
+                # Grant permissions on the table to bedrock_user
+                logger.info("Granting permissions on bedrock_kb table to bedrock_user")
+                rds_client.execute_statement(
+                    **db_params,
+                    transactionId=transaction_id,
+                    sql=_SQL_GRANT_TABLE
+                )
+                
+                rds_client.commit_transaction(
+                    resourceArn=cluster_arn,
+                    secretArn=secret_arn,
+                    transactionId=transaction_id
+                )
+            except Exception:
+                rds_client.rollback_transaction(
+                    resourceArn=cluster_arn,
+                    secretArn=secret_arn,
+                    transactionId=transaction_id
+                )
+                raise
             
-            # Create text search index
-            logger.info("Creating text search index")
-            rds_client.execute_statement(
-                resourceArn=cluster_arn,
-                secretArn=secret_arn,
-                database=database_name,
-                sql='CREATE INDEX IF NOT EXISTS chunks_idx ON bedrock_integration.bedrock_kb USING gin (to_tsvector(\'simple\', chunks));'
-            )
+            # The indexes are independent, so build the missing ones concurrently, each in its own transaction
+            missing_indexes = [sql for name, sql in _SQL_CREATE_INDEXES.items() if name not in existing_objects]
+            if missing_indexes:
+                logger.info(f"Creating {len(missing_indexes)} indexes with HNSW (m={HNSW_M}, ef_construction={HNSW_EF_CONSTRUCTION}), "
+                            f"{MAINTENANCE_WORK_MEM} build memory and {MAX_PARALLEL_MAINTENANCE_WORKERS} parallel workers")
+                with ThreadPoolExecutor(max_workers=len(missing_indexes)) as executor:
+                    # Consume the results so that any failed build is raised here
+                    list(executor.map(lambda sql: create_index(db_params, sql), missing_indexes))
+            else:
+                logger.info("All indexes already exist")
             
-            # Create metadata index
-            logger.info("Creating metadata index")
-            rds_client.execute_statement(
-                resourceArn=cluster_arn,
-                secretArn=secret_arn,
-                database=database_name,
-                sql='CREATE INDEX IF NOT EXISTS metadata_idx ON bedrock_integration.bedrock_kb USING gin (custom_metadata);'
-            )
+            # Raise query time recall for the knowledge base sessions. This runs after the commit
+            # so that a missing hnsw.ef_search setting cannot roll back the setup.
+            logger.info(f"Setting hnsw.ef_search to {HNSW_EF_SEARCH} for bedrock_user")
+            try:
+                rds_client.execute_statement(
+                    **db_params,
+                    sql=_SQL_SET_EF_SEARCH
+                )
+            except Exception as e:
+                # The index still works with the default ef_search
+                logger.warning(f"Could not set hnsw.ef_search: {str(e)}")
             
             response_data = {'Message': 'Vector extension, schema, tables, and indexes created successfully'}
             metrics.add_metric(name="VectorInitSuccess", unit="Count", value=1)
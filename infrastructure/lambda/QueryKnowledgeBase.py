@@ -1,42 +1,35 @@
-import json
 import os
-import boto3
 from botocore.exceptions import ClientError
 from aws_lambda_powertools.utilities.typing import LambdaContext
 from common_utils import (
     logger, tracer, metrics, 
-    create_response, handle_options_request, 
-    handle_client_error, handle_general_exception
+    get_bedrock_agent_runtime,
+    create_response, cors_preflight,
+    json_loads, json_dumps,
+    create_serialized_response, UNSUPPORTED_OPERATION_BODY,
+    lambda_error_boundary
 )
 
-# Initialize AWS clients
-bedrock_agent_runtime = boto3.client('bedrock-agent-runtime')
+# Constant error bodies, serialized once per container
+_ERR_QUERY_REQUIRED = json_dumps({'error': 'Query text is required'})
+_ERR_KNOWLEDGE_BASE_NOT_CONFIGURED = json_dumps({'error': 'Knowledge base ID not configured'})
 
+@cors_preflight
 @logger.inject_lambda_context
 @tracer.capture_lambda_handler
 @metrics.log_metrics
+@lambda_error_boundary
 def handler(event, context: LambdaContext):
-    try:
-        # Check if this is a preflight OPTIONS request
-        options_response = handle_options_request(event)
-        if options_response:
-            return options_response
-        
-        # Get the path and method to determine the operation
-        path = event.get('path', '')
-        http_method = event.get('httpMethod', '')
-        
-        # Handle different API endpoints
-        if path.endswith('/knowledge-base/query') and http_method == 'POST':
-            return handle_query(event)
-        else:
-            logger.warning(f"Unsupported path or method: {path}, {http_method}")
-            return create_response(event, 400, {'error': 'Unsupported operation'})
-            
-    except boto3.exceptions.botocore.exceptions.ClientError as e:
-        return handle_client_error(event, e)
-    except Exception as e:
-        return handle_general_exception(event, e)
+    # Get the path and method to determine the operation
+    path = event.get('path', '')
+    http_method = event.get('httpMethod', '')
+    
+    # Handle different API endpoints
+    if path.endswith('/knowledge-base/query') and http_method == 'POST':
+        return handle_query(event)
+    else:
+        logger.warning(f"Unsupported path or method: {path}, {http_method}")
+        return create_serialized_response(event, 400, UNSUPPORTED_OPERATION_BODY)
 
 @tracer.capture_method
 def perform_retrieve_and_generate(retrieve_params):
@@ -52,7 +45,7 @@ def perform_retrieve_and_generate(retrieve_params):
     try:
         # First attempt with the provided session ID (if any)
         logger.info("Attempting retrieve_and_generate with provided parameters")
-        response = bedrock_agent_runtime.retrieve_and_generate(**retrieve_params)
+        response = get_bedrock_agent_runtime().retrieve_and_generate(**retrieve_params)
         return response, False  # No session ID change
     except ClientError as e:
         error_code = e.response.get('Error', {}).get('Code', 'Unknown')
@@ -71,7 +64,7 @@ def perform_retrieve_and_generate(retrieve_params):
                 logger.info(f"Removed invalid session ID: {old_session_id}")
                 
                 # Retry without the session ID
-                response = bedrock_agent_runtime.retrieve_and_generate(**retrieve_params)
+                response = get_bedrock_agent_runtime().retrieve_and_generate(**retrieve_params)
                 return response, True  # Session ID was changed
             else:
                 # This shouldn't happen, but just in case
@@ -88,14 +81,14 @@ def handle_query(event):
     Handle POST /knowledge-base/query endpoint
     """
     # Parse the request body
-    body = json.loads(event.get('body', '{}'))
+    body = json_loads(event.get('body') or '{}')
     
     # Get the query text from the request
     query = body.get('query')
     if not query:
         logger.warning("Missing query text in request")
         metrics.add_metric(name="MissingQueryError", unit="Count", value=1)
-        return create_response(event, 400, {'error': 'Query text is required'})
+        return create_serialized_response(event, 400, _ERR_QUERY_REQUIRED)
     
     # Get the session ID from the request (if provided)
     session_id = body.get('sessionId')
@@ -107,7 +100,7 @@ def handle_query(event):
     if not knowledge_base_id:
         logger.error("Knowledge base ID not configured")
         metrics.add_metric(name="MissingKnowledgeBaseId", unit="Count", value=1)
-        return create_response(event, 500, {'error': 'Knowledge base ID not configured'})
+        return create_serialized_response(event, 500, _ERR_KNOWLEDGE_BASE_NOT_CONFIGURED)
     
     # Get the guardrail ID from the query
     guardrail_id = body.get('guardrailId')
@@ -120,6 +113,27 @@ def handle_query(event):
     
     logger.info(f"Processing knowledge base query: '{query}' with session ID: {session_id or 'None'}")
 
+    # Inference configuration for the generation step
+    generation_configuration = {
+        'inferenceConfig': {
+            'textInferenceConfig': {
+                'maxTokens': 1024,  # Adjust as needed
+                'temperature': 0.7,  # Adjust as needed
+                'topP': 0.9  # Adjust as needed
+            }
+        },
+        'performanceConfig': {
+            'latency': 'standard'
+        }
+    }
+    
+    # Add guardrail configuration if guardrail_id is available
+    if guardrail_id:
+        generation_configuration['guardrailConfiguration'] = {
+            'guardrailId': guardrail_id,
+            'guardrailVersion': guardrail_version
+        }
+
     # Create base parameters for the API call
     retrieve_params = {
         'input': {
@@ -135,7 +149,8 @@ def handle_query(event):
                         'numberOfResults': limit,
                         'overrideSearchType': 'HYBRID'  # Enable hybrid search (semantic & text)
                     }
-                }
+                },
+                'generationConfiguration': generation_configuration
             }
         }
     }
@@ -144,30 +159,6 @@ def handle_query(event):
     if session_id:
         retrieve_params['sessionId'] = session_id
         logger.info(f"Using existing session ID: {session_id}")
-    
-    # Add guardrail configuration if guardrail_id is available
-    if guardrail_id:
-        retrieve_params['retrieveAndGenerateConfiguration']['knowledgeBaseConfiguration']['generationConfiguration'] = {
-            'guardrailConfiguration': {  # Note: guardrailConfiguration is nested under generationConfiguration
-                'guardrailId': guardrail_id,
-                'guardrailVersion': guardrail_version
-            }
-        }
-
-    # Optionally, you might want to add inference configuration
-    retrieve_params['retrieveAndGenerateConfiguration']['knowledgeBaseConfiguration']['generationConfiguration'] = {
-        **retrieve_params['retrieveAndGenerateConfiguration']['knowledgeBaseConfiguration'].get('generationConfiguration', {}),
-        'inferenceConfig': {
-            'textInferenceConfig': {
-                'maxTokens': 1024,  # Adjust as needed
-                'temperature': 0.7,  # Adjust as needed
-                'topP': 0.9  # Adjust as needed
-            }
-        },
-        'performanceConfig': {
-            'latency': 'standard'
-        }
-    }
 
     # Query the knowledge base using retrieve_and_generate with error handling
     logger.info(f"Querying knowledge base: {knowledge_base_id}")
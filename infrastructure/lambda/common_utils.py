@@ -1,26 +1,190 @@
+import functools
 import json
 import os
+import time
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from decimal import Decimal
 from datetime import datetime, date
-from aws_lambda_powertools import Logger, Tracer, Metrics
+from aws_lambda_powertools import Logger
 
-# Initialize powertools
-logger = Logger()
-tracer = Tracer()
-metrics = Metrics()
+# Prefer orjson for JSON (de)serialization, then msgspec, falling back to the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-# Initialize AWS clients
-bedrock_agent_runtime = boto3.client('bedrock-agent-runtime')
+msgspec = None
+if orjson is None:
+    try:
+        import msgspec
+    except ImportError:
+        pass
 
-class DecimalEncoder(json.JSONEncoder):
-    """JSON encoder that handles Decimal and datetime objects."""
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)  # Convert Decimal to float
-        elif isinstance(obj, (datetime, date)):
-            return obj.isoformat()  # Convert datetime to ISO format string
-        return super(DecimalEncoder, self).default(obj)
+# Initialize powertools. The logger is cheap and used everywhere; the tracer (X-Ray SDK
+# patching) and metrics are built on first access through the module __getattr__ below.
+# Log records keep a short key order and are serialized with orjson when it is installed.
+_logger_options = {'log_record_order': ["level", "message", "location"]}
+if orjson is not None:
+    _logger_options['json_serializer'] = lambda log: orjson.dumps(
+        log, default=str, option=orjson.OPT_NON_STR_KEYS
+    ).decode()
+logger = Logger(**_logger_options)
+
+@functools.lru_cache(maxsize=1)
+def get_tracer():
+    """
+    Get the shared Powertools tracer, created on first use.
+    
+    Returns:
+        Tracer: The tracer
+    """
+    from aws_lambda_powertools import Tracer
+    return Tracer()
+
+@functools.lru_cache(maxsize=1)
+def get_metrics():
+    """
+    Get the shared Powertools metrics, created on first use.
+    
+    Returns:
+        Metrics: The metrics
+    """
+    from aws_lambda_powertools import Metrics
+    return Metrics()
+
+def __getattr__(name):
+    # Keep `from common_utils import tracer, metrics` working for the handlers
+    if name == 'tracer':
+        return get_tracer()
+    if name == 'metrics':
+        return get_metrics()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Shared client configuration: keep-alive connections, a pool sized for parallel calls
+# and adaptive retries with a bounded number of attempts
+AWS_CLIENT_CONFIG = Config(
+    max_pool_connections=32,
+    retries={'mode': 'adaptive', 'max_attempts': 3},
+    tcp_keepalive=True,
+    connect_timeout=2,
+    read_timeout=30
+)
+
+# Agent and model invocations can take longer than control plane calls to start responding
+RUNTIME_CLIENT_CONFIG = AWS_CLIENT_CONFIG.merge(Config(read_timeout=90))
+
+@functools.lru_cache(maxsize=1)
+def get_bedrock_agent_runtime():
+    """
+    Get the shared bedrock-agent-runtime client, created on first use so that
+    functions which import common_utils without calling agents never build it.
+    
+    Returns:
+        The bedrock-agent-runtime boto3 client
+    """
+    return boto3.client('bedrock-agent-runtime', config=RUNTIME_CLIENT_CONFIG)
+
+# Converters for the exact types JSON encoders do not handle natively
+_JSON_DEFAULT_DISPATCH = {
+    Decimal: float,  # Convert Decimal to float
+    datetime: datetime.isoformat,  # Convert datetime to ISO format string
+    date: date.isoformat
+}
+
+def _json_default(obj):
+    """
+    Serialize the types JSON encoders do not handle natively.
+    orjson encodes datetime and date itself, so it only calls this for Decimal.
+    
+    Args:
+        obj: The object to serialize
+        
+    Returns:
+        float | str: JSON compatible value
+    """
+    convert = _JSON_DEFAULT_DISPATCH.get(type(obj))
+    if convert is not None:
+        return convert(obj)
+    # Subclasses are rare here and fall back to the isinstance checks
+    if isinstance(obj, Decimal):
+        return float(obj)  # Convert Decimal to float
+    elif isinstance(obj, (datetime, date)):
+        return obj.isoformat()  # Convert datetime to ISO format string
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+# msgspec encodes datetime natively; decimal_format keeps Decimal values numeric as with orjson
+_msgspec_encoder = msgspec.json.Encoder(enc_hook=_json_default, decimal_format='number') if msgspec is not None else None
+
+def json_loads(data):
+    """
+    Deserialize a JSON document, using orjson or msgspec when available.
+    
+    Args:
+        data (str | bytes): The JSON document
+        
+    Returns:
+        The deserialized object
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    if msgspec is not None:
+        try:
+            return msgspec.json.decode(data)
+        except msgspec.DecodeError as e:
+            # Keep callers' json.JSONDecodeError handling working, as orjson's error subclasses it
+            raise json.JSONDecodeError(str(e), data if isinstance(data, str) else '', 0) from e
+    return json.loads(data)
+
+def json_dumps(obj):
+    """
+    Serialize an object to a JSON string, using orjson or msgspec when available.
+    
+    Args:
+        obj: The object to serialize
+        
+    Returns:
+        str: The JSON document
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+    if _msgspec_encoder is not None:
+        return _msgspec_encoder.encode(obj).decode()
+    # default= keeps the C encoder (cls= would force the pure Python one) and compact
+    # separators match the orjson output
+    return json.dumps(obj, default=_json_default, separators=(',', ':'))
+
+# Shared stand-in for missing request headers, never mutated
+_EMPTY = {}
+
+class _CIDict(dict):
+    """Request headers with lowercased names, so each header is a single lookup."""
+    def __init__(self, headers):
+        super().__init__((name.lower(), value) for name, value in (headers or _EMPTY).items())
+
+# CORS settings that do not depend on the request, read once per container
+_ALLOWED_HEADERS = os.environ.get('ALLOWED_HEADERS', 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token')
+
+@functools.lru_cache(maxsize=32)
+def _headers_for_origin(origin):
+    """
+    Build the CORS headers for an origin once; the handful of origins a deployment
+    sees are served from the cache afterwards.
+    
+    Args:
+        origin (str): Value for Access-Control-Allow-Origin
+        
+    Returns:
+        tuple: Immutable (name, value) header pairs
+    """
+    return (
+        ('Content-Type', 'application/json'),
+        ('Access-Control-Allow-Headers', _ALLOWED_HEADERS),
+        ('Access-Control-Allow-Methods', 'GET, OPTIONS, POST, PUT, DELETE'),
+        ('Access-Control-Allow-Credentials', 'true'),
+        ('Access-Control-Allow-Origin', origin)
+    )
 
 def get_cors_headers(event):
     """
@@ -32,20 +196,19 @@ def get_cors_headers(event):
     Returns:
         dict: Dictionary containing CORS headers
     """
-    # Get origin from the request headers
-    origin = event.get('headers', {}).get('origin') or event.get('headers', {}).get('Origin')
+    # Get origin from the request headers (null when the request has none). Headers
+    # normalized by cors_preflight need one lookup, raw headers may use either case.
+    headers = event.get('headers') or _EMPTY
+    if isinstance(headers, _CIDict):
+        origin = headers.get('origin')
+    else:
+        origin = headers.get('origin') or headers.get('Origin')
     
     # For credentialed requests, we must specify the exact origin
     access_control_origin = origin if origin else 'http://localhost:8000'
     
-    headers = {
-        'Content-Type': 'application/json',
-        'Access-Control-Allow-Headers': os.environ.get('ALLOWED_HEADERS', 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'),
-        'Access-Control-Allow-Methods': 'GET, OPTIONS, POST, PUT, DELETE',
-        'Access-Control-Allow-Credentials': 'true',
-        'Access-Control-Allow-Origin': access_control_origin
-    }
-    return headers
+    # Return a fresh dict so callers can't modify the cached headers
+    return dict(_headers_for_origin(access_control_origin))
 
 def create_response(event, status_code, body):
     """
@@ -59,12 +222,39 @@ def create_response(event, status_code, body):
     Returns:
         dict: Formatted API Gateway response
     """
+    # Built inline rather than through create_serialized_response to save a call per response
     return {
         'statusCode': status_code,
         'headers': get_cors_headers(event),
-        'body': json.dumps(body, cls=DecimalEncoder)
+        'body': json_dumps(body)
     }
 
+def create_serialized_response(event, status_code, body_json):
+    """
+    Create a standardized API Gateway response from an already serialized body,
+    such as the constant error bodies serialized once at import time.
+    
+    Args:
+        event: The Lambda event object
+        status_code (int): HTTP status code
+        body_json (str): JSON encoded response body
+        
+    Returns:
+        dict: Formatted API Gateway response
+    """
+    return {
+        'statusCode': status_code,
+        'headers': get_cors_headers(event),
+        'body': body_json
+    }
+
+# Constant error bodies shared by the handlers, serialized once per container
+UNSUPPORTED_OPERATION_BODY = json_dumps({'error': 'Unsupported operation'})
+_GENERIC_500_BODY = json_dumps({'error': 'Internal server error'})
+
+# Preflight responses differ only in the allowed origin, so their body is serialized once
+_OPTIONS_BODY = json_dumps({})
+
 def handle_options_request(event):
     """
     Handle OPTIONS preflight requests for CORS.
@@ -75,9 +265,73 @@ def handle_options_request(event):
     Returns:
         dict: API Gateway response for OPTIONS request
     """
-    if event.get('httpMethod') == 'OPTIONS':
-        return create_response(event, 200, {})
-    return None
+    # REST APIs (v1) send httpMethod, HTTP APIs (v2) send requestContext.http.method
+    method = event.get('httpMethod') or ((event.get('requestContext') or _EMPTY).get('http') or _EMPTY).get('method')
+    if method != 'OPTIONS':
+        return None
+    return {
+        'statusCode': 200,
+        'headers': get_cors_headers(event),
+        'body': _OPTIONS_BODY
+    }
+
+def cors_preflight(handler):
+    """
+    Decorator normalizing the request headers and answering OPTIONS preflight requests
+    before the wrapped handler runs.
+    Apply it outermost so preflights skip the Powertools logger, tracer and metrics wrappers.
+    
+    Args:
+        handler: The Lambda handler to wrap
+        
+    Returns:
+        The wrapped Lambda handler
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        # Normalize the header names once at the API Gateway boundary
+        event['headers'] = _CIDict(event.get('headers'))
+        if options_response := handle_options_request(event):
+            return options_response
+        return handler(event, context)
+    return wrapper
+
+# Embedded Metric Format record for a single error count, with the same namespace and
+# service dimension Powertools uses, so error metrics can be written without buffering
+_METRICS_NAMESPACE = os.environ.get('POWERTOOLS_METRICS_NAMESPACE')
+_EMF_ERROR_TEMPLATE = (
+    '{"_aws":{"Timestamp":%d,"CloudWatchMetrics":[{"Namespace":' + json_dumps(_METRICS_NAMESPACE)
+    + ',"Dimensions":[["service"]],"Metrics":[{"Name":"%s","Unit":"Count"}]}]},"service":'
+    + json_dumps(os.environ.get('POWERTOOLS_SERVICE_NAME', 'service_undefined')) + ',"%s":1}'
+)
+
+def _emit_error_metric(metric_name):
+    """
+    Write a single error count metric straight to the log as an EMF record.
+    
+    Args:
+        metric_name (str): Name of the metric to record
+    """
+    if _METRICS_NAMESPACE is None:
+        # Without a namespace EMF records are dropped, let Powertools report the problem
+        get_metrics().add_metric(name=metric_name, unit="Count", value=1)
+        return
+    print(_EMF_ERROR_TEMPLATE % (int(time.time() * 1000), metric_name, metric_name))
+
+def _error_response(event, metric_name, body_json):
+    """
+    Record an error metric and build the error response shared by the error handlers.
+    
+    Args:
+        event: The Lambda event object
+        metric_name (str): Name of the metric to record
+        body_json (str): JSON encoded response body
+        
+    Returns:
+        dict: API Gateway error response
+    """
+    _emit_error_metric(metric_name)
+    return create_serialized_response(event, 500, body_json)
 
 def handle_client_error(event, e, metric_name="AWSClientError"):
     """
@@ -93,9 +347,8 @@ def handle_client_error(event, e, metric_name="AWSClientError"):
     """
     error_code = e.response.get('Error', {}).get('Code', 'Unknown')
     error_message = e.response.get('Error', {}).get('Message', str(e))
-    logger.error(f"AWS Client Error: {error_code} - {error_message}")
-    metrics.add_metric(name=metric_name, unit="Count", value=1)
-    return create_response(event, 500, {'error': f"AWS Error: {error_code} - {error_message}"})
+    logger.error("AWS Client Error", extra={'error_code': error_code, 'error_message': error_message})
+    return _error_response(event, metric_name, json_dumps({'error': f"AWS Error: {error_code} - {error_message}"}))
 
 def handle_general_exception(event, e, metric_name="ProcessingError"):
     """
@@ -109,6 +362,35 @@ def handle_general_exception(event, e, metric_name="ProcessingError"):
     Returns:
         dict: API Gateway error response
     """
-    logger.exception(f"Error processing request: {str(e)}")
-    metrics.add_metric(name=metric_name, unit="Count", value=1)
-    return create_response(event, 500, {'error': f"Internal server error"})
+    # The logged traceback already carries the exception message
+    logger.exception("Error processing request", extra={'exc_type': type(e).__name__})
+    return _error_response(event, metric_name, _GENERIC_500_BODY)
+
+def lambda_error_boundary(handler=None, *, client_error_metric="AWSClientError", error_metric="ProcessingError"):
+    """
+    Decorator turning exceptions escaping a handler into API Gateway error responses,
+    so handlers don't need their own try/except plumbing. Use it bare or with custom
+    metric names, innermost below the Powertools decorators.
+    
+    Args:
+        handler: The Lambda handler to wrap
+        client_error_metric (str): Metric recorded for AWS client errors
+        error_metric (str): Metric recorded for any other exception
+        
+    Returns:
+        The wrapped Lambda handler
+    """
+    if handler is None:
+        return functools.partial(
+            lambda_error_boundary, client_error_metric=client_error_metric, error_metric=error_metric
+        )
+    
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        except ClientError as e:
+            return handle_client_error(event, e, client_error_metric)
+        except Exception as e:
+            return handle_general_exception(event, e, error_metric)
+    return wrapper
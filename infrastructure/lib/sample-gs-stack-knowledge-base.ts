@@ -137,12 +137,30 @@ export class SampleGSStackKnowledgeBase extends Construct {
       retainOnDelete: false,
     });
 
-    // Create a Lambda function to sync the knowledge base after deployment
+    // Create a Lambda function to start the knowledge base sync after deployment
     const syncKnowledgeBaseFunction = new lambda.Function(this, 'SyncKnowledgeBaseFunction', {
       runtime: lambda.Runtime.PYTHON_3_12,
       handler: 'SyncKnowledgeBase.handler',
-      memorySize: 2048,
-      timeout: cdk.Duration.minutes(10),
+      memorySize: 256,
+      timeout: cdk.Duration.minutes(1),
+      code: lambda.Code.fromAsset(path.join(__dirname, '../lambda')),
+      layers: [props.lambdaLayers.powertoolsLayer, props.lambdaLayers.sampleGSLayer],
+      environment: {
+        KNOWLEDGE_BASE_ID: this.knowledgeBase.attrKnowledgeBaseId,
+        DATA_SOURCE_ID: this.dataSource.attrDataSourceId,
+        // Add PowerTools environment variables
+        ...props.lambdaLayers.powertoolsEnv
+      },
+      tracing: lambda.Tracing.ACTIVE,
+      logRetention: logs.RetentionDays.ONE_MONTH
+    });
+
+    // Create a Lambda function that checks the ingestion job once per poll
+    const syncKnowledgeBaseStatusFunction = new lambda.Function(this, 'SyncKnowledgeBaseStatusFunction', {
+      runtime: lambda.Runtime.PYTHON_3_12,
+      handler: 'SyncKnowledgeBase.is_complete',
+      memorySize: 256,
+      timeout: cdk.Duration.minutes(1),
       code: lambda.Code.fromAsset(path.join(__dirname, '../lambda')),
       layers: [props.lambdaLayers.powertoolsLayer, props.lambdaLayers.sampleGSLayer],
       environment: {
@@ -156,7 +174,7 @@ export class SampleGSStackKnowledgeBase extends Construct {
     });
 
     // Add permissions for Bedrock knowledge base operations
-    syncKnowledgeBaseFunction.addToRolePolicy(new iam.PolicyStatement({
+    const ingestionJobPolicy = new iam.PolicyStatement({
       effect: iam.Effect.ALLOW,
       actions: [
         'bedrock:StartIngestionJob',
@@ -164,11 +182,17 @@ export class SampleGSStackKnowledgeBase extends Construct {
         'bedrock:ListIngestionJobs'
       ],
       resources: [`arn:aws:bedrock:${cdk.Stack.of(this).region}:${cdk.Stack.of(this).account}:knowledge-base/*`]
-    }));
+    });
+    syncKnowledgeBaseFunction.addToRolePolicy(ingestionJobPolicy);
+    syncKnowledgeBaseStatusFunction.addToRolePolicy(ingestionJobPolicy);
 
-    // Create a custom resource that will trigger the Lambda
+    // Create a custom resource that will trigger the Lambda. The provider polls the
+    // ingestion job from its own state machine, so no Lambda stays running while it waits.
     const syncKnowledgeBaseProvider = new cdk.custom_resources.Provider(this, 'SyncKnowledgeBaseProvider', {
       onEventHandler: syncKnowledgeBaseFunction,
+      isCompleteHandler: syncKnowledgeBaseStatusFunction,
+      queryInterval: cdk.Duration.seconds(15),
+      totalTimeout: cdk.Duration.minutes(10),
       logRetention: logs.RetentionDays.ONE_WEEK
     });
 